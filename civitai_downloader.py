@@ -1,38 +1,185 @@
 import os
 import requests
 import time
+import hashlib
+import json
+import sqlite3
+from functools import partial
+from threading import Lock
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from tqdm import tqdm
+from tqdm.contrib.concurrent import thread_map
 
 # Civitai API 端点
 API_BASE_URL = "https://civitai.com/api/v1"
 
-def get_all_creator_images(api_key, username, nsfw, sort):
+# 并发下载线程数，所有线程合计每秒最多发起的下载请求数，以及每秒最多请求的 API 页数
+MAX_WORKERS = 16
+DOWNLOAD_RATE = 20
+API_RATE = 1
+# 流式写入文件时每次读取的字节数
+CHUNK_SIZE = 1024 * 1024
+
+# 全局共享的 HTTP 会话：复用 TCP/TLS 连接（keep-alive + 连接池），对临时错误自动重试
+SESSION = requests.Session()
+SESSION.mount("https://", HTTPAdapter(
+    pool_connections=MAX_WORKERS,
+    pool_maxsize=MAX_WORKERS,
+    max_retries=Retry(total=3, backoff_factor=0.3, status_forcelist=[429, 500, 502, 503, 504]),
+))
+
+class RateLimiter:
+    """
+    令牌桶限速器：按 rate（次/秒）补充令牌，最多积攒 capacity 个（默认等于 rate），多个线程共享。
+    只在超出速率时才等待，取代每次请求后固定的 sleep。
+    """
+    def __init__(self, rate, capacity=None):
+        self.rate = rate
+        self.capacity = capacity or rate
+        self.tokens = self.capacity
+        self.last = time.monotonic()
+        self.lock = Lock()
+
+    def acquire(self):
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.capacity, self.tokens + (now - self.last) * self.rate)
+            self.last = now
+            wait = (1 - self.tokens) / self.rate if self.tokens < 1 else 0
+            self.tokens -= 1
+        if wait > 0:
+            time.sleep(wait)
+
+class DownloadIndex:
+    """
+    本地下载索引（SQLite）：按图片ID记录文件路径、大小和 sha256。
+    Civitai 的图片按 ID 不可变：再次运行时索引中记录的文件仍存在即直接跳过，无需任何网络请求，
+    也不受文件命名方式变化的影响。
+    """
+    def __init__(self, db_path):
+        self.conn = sqlite3.connect(db_path, check_same_thread=False)
+        self.lock = Lock()
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS images ("
+            "image_id INTEGER PRIMARY KEY, path TEXT, size INTEGER, sha256 TEXT, last_access REAL)"
+        )
+
+    def lookup(self, image_id):
+        """返回该图片ID上次保存的文件路径；未下载过则返回 None。"""
+        with self.lock:
+            row = self.conn.execute("SELECT path FROM images WHERE image_id = ?", (image_id,)).fetchone()
+        return row[0] if row else None
+
+    def record(self, image_id, path, size, sha256):
+        """下载完成后记录文件路径、大小和 sha256。"""
+        with self.lock:
+            # 显式列出列名，旧版本创建的索引（带 etag / last_modified 列）也能继续使用
+            self.conn.execute(
+                "INSERT OR REPLACE INTO images (image_id, path, size, sha256, last_access) VALUES (?, ?, ?, ?, ?)",
+                (image_id, path, size, sha256, time.time()),
+            )
+
+    def touch(self, image_id):
+        """跳过已下载的图片时刷新最近访问时间，供 LRU 淘汰使用。"""
+        with self.lock:
+            self.conn.execute("UPDATE images SET last_access = ? WHERE image_id = ?", (time.time(), image_id))
+
+    def evict(self, max_bytes):
+        """总大小超过 max_bytes 时，按最近最少使用的顺序删除旧文件，返回删除的数量。"""
+        removed = 0
+        with self.lock:
+            total = self.conn.execute("SELECT COALESCE(SUM(size), 0) FROM images").fetchone()[0]
+            rows = self.conn.execute("SELECT image_id, path, size FROM images ORDER BY last_access").fetchall()
+            for image_id, path, size in rows:
+                if total <= max_bytes:
+                    break
+                if os.path.exists(path):
+                    os.remove(path)
+                self.conn.execute("DELETE FROM images WHERE image_id = ?", (image_id,))
+                total -= size
+                removed += 1
+        return removed
+
+    def close(self):
+        with self.lock:
+            self.conn.commit()
+            self.conn.close()
+
+def load_sync_state(state_path):
+    """读取增量同步状态（每组查询条件上次见到的最新图片ID和列表 ETag）。"""
+    if os.path.exists(state_path):
+        with open(state_path, 'r') as f:
+            return json.load(f)
+    return {}
+
+def save_sync_state(state_path, state):
+    with open(state_path, 'w') as f:
+        json.dump(state, f, indent=4)
+
+def get_all_creator_images(username, nsfw, sort, state=None):
     """
     通过分页获取指定创作者的所有图片信息。
     API 单次请求有数量限制，此函数会自动处理分页，直到获取所有图片。
+    传入 state 且按 'Newest' 排序时只做增量获取：先用 limit=1 的条件请求检查最新图片，
+    列表未变化则直接返回空列表；否则翻页到上次见到的最新图片为止。
+    只有完整翻页（到达最后一页或上次见到的最新图片）后才更新 state，中途出错时保持不变，
+    避免下次运行误以为已获取过中断后未取到的图片。
     """
     all_images = []
-    page_url = f"{API_BASE_URL}/images?username={username}&sort={sort}&limit=100"
+    query = f"{API_BASE_URL}/images?username={username}&sort={sort}"
     if nsfw is not None:
-        page_url += f"&nsfw={str(nsfw).lower()}"
-        
-    headers = {"Authorization": f"Bearer {api_key}"}
+        query += f"&nsfw={str(nsfw).lower()}"
+    page_url = f"{query}&limit=100"
+    # 为防止 API 请求过于频繁，用令牌桶限制翻页速率；遇到 429 时会话的重试策略会按 Retry-After 等待
+    limiter = RateLimiter(API_RATE)
+
+    last_seen_id = None
+    new_etag = None
+    completed = False
+    if state is not None and sort == 'Newest':
+        last_seen_id = state.get('last_seen_id')
+
+    if last_seen_id:
+        try:
+            limiter.acquire()
+            headers = {"If-None-Match": state['etag']} if state.get('etag') else {}
+            response = SESSION.get(f"{query}&limit=1", headers=headers, timeout=20)
+            if response.status_code == 304:
+                print("图片列表未变化，没有新图片。")
+                return []
+            response.raise_for_status()
+            new_etag = response.headers.get('ETag')
+            newest = response.json().get('items', [])
+            if newest and newest[0].get('id') == last_seen_id:
+                print("最新图片与上次相同，没有新图片。")
+                return []
+        except requests.exceptions.RequestException as e:
+            print(f"检查新图片时发生错误，改为完整获取: {e}")
+            last_seen_id = None
 
     while page_url:
         try:
+            limiter.acquire()
             print(f"正在从 URL 获取数据: {page_url.split('?')[0]}...")
-            response = requests.get(page_url, headers=headers)
+            response = SESSION.get(page_url)
             response.raise_for_status()  # 如果请求失败 (例如 4xx 或 5xx 错误), 则抛出异常
 
             data = response.json()
             images = data.get('items', [])
+            
+            # 增量模式：遇到上次见到的最新图片即停止，之后的都已下载过
+            ids = [image.get('id') for image in images]
+            if last_seen_id and last_seen_id in ids:
+                all_images.extend(images[:ids.index(last_seen_id)])
+                completed = True
+                break
             all_images.extend(images)
             
             # 获取下一页的链接以进行分页
             page_url = data.get('metadata', {}).get('nextPage')
-            
-            # 为防止 API 请求过于频繁，增加一个小的延时
-            if page_url:
-                time.sleep(1)
+            if not page_url:
+                completed = True
 
         except requests.exceptions.HTTPError as e:
             print(f"HTTP 错误: {e.response.status_code} - {e.response.text}")
@@ -40,41 +187,76 @@ def get_all_creator_images(api_key, username, nsfw, sort):
         except requests.exceptions.RequestException as e:
             print(f"请求时发生错误: {e}")
             break
+    
+    if state is not None and sort == 'Newest' and completed and all_images:
+        state['last_seen_id'] = all_images[0].get('id')
+        if new_etag:
+            state['etag'] = new_etag
             
     return all_images
 
-def download_image(image_info, folder_path):
-    """根据图片信息下载单个图片。"""
-    image_url = image_info.get('url')
-    image_id = image_info.get('id')
-    creator_username = image_info.get('user', {}).get('username', 'unknown_creator')
-
-    if not image_url or not image_id:
-        print(f"信息不完整，跳过下载: {image_info}")
-        return False
+def build_download_jobs(images, folder_path):
+    """
+    在下载开始前一次性为每张图片生成 (图片ID, URL, 文件名, 文件路径)，
+    下载线程只负责下载和保存，不再重复做字符串拆分和路径拼接。
+    """
+    jobs = []
+    for image_info in images:
+        image_url = image_info.get('url')
+        image_id = image_info.get('id')
+        if not image_url or not image_id:
+            print(f"信息不完整，跳过下载: {image_info}")
+            continue
 
-    try:
         # 提取原始文件名和扩展名，构建一个清晰的文件名
         # 格式：创作者名_图片ID.扩展名
-        file_extension = os.path.splitext(image_url.split('?')[0])[-1] or '.png'
+        creator_username = image_info.get('user', {}).get('username', 'unknown_creator')
+        file_extension = os.path.splitext(image_url.partition('?')[0])[1] or '.png'
         filename = f"{creator_username}_{image_id}{file_extension}"
-        file_path = os.path.join(folder_path, filename)
-        
-        if os.path.exists(file_path):
-            print(f"文件已存在，跳过: {filename}")
+        jobs.append((image_id, image_url, filename, os.path.join(folder_path, filename)))
+    return jobs
+
+def download_image(job, limiter=None, index=None, existing=None):
+    """
+    下载 build_download_jobs 生成的单个任务。此函数将在多线程中执行。
+    文件夹中已有同名文件时直接跳过；传入 index 时，还会跳过以旧文件名保存过的图片。
+    existing 为下载文件夹中已有文件名的集合，用于免去逐个文件的 stat 检查。
+    """
+    image_id, image_url, filename, file_path = job
+
+    try:
+        # 图片按 ID 不可变，本地已有即跳过，不发请求也不占用限速令牌
+        already_exists = filename in existing if existing is not None else os.path.exists(file_path)
+        if already_exists:
+            if index:
+                index.touch(image_id)
             return True
+        # 只有当前文件名不存在时才查询索引，找出以旧命名方式保存过的文件
+        if index:
+            old_path = index.lookup(image_id)
+            if old_path and os.path.exists(old_path):
+                index.touch(image_id)
+                return True
 
-        print(f"正在下载: {filename}")
-        response = requests.get(image_url, stream=True, timeout=30)
-        response.raise_for_status()
-        
-        with open(file_path, 'wb') as f:
-            for chunk in response.iter_content(chunk_size=8192):
-                f.write(chunk)
+        if limiter:
+            limiter.acquire()
+        with SESSION.get(image_url, stream=True, timeout=30) as response:
+            response.raise_for_status()
+            
+            # 以 1MB 为块写入（原为 8KB），大幅减少 Python 层循环次数和 write 调用
+            size = 0
+            digest = hashlib.sha256()
+            with open(file_path, 'wb') as f:
+                for chunk in response.iter_content(chunk_size=CHUNK_SIZE):
+                    f.write(chunk)
+                    size += len(chunk)
+                    digest.update(chunk)
+            if index:
+                index.record(image_id, file_path, size, digest.hexdigest())
         return True
 
     except requests.exceptions.RequestException as e:
-        print(f"下载图片失败 {image_url}: {e}")
+        tqdm.write(f"下载图片失败 {image_url}: {e}")
         return False
 
 def main():
@@ -104,6 +286,14 @@ def main():
     # - 'Most Comments': 最多评论
     # - 'Most Buzz': 最多讨论
     SORT_ORDER = 'Most Reactions'
+
+    # 5. 【可选】下载索引与磁盘占用上限
+    # 索引按图片ID记录已下载的文件，文件命名方式改变后再次运行也不会重复下载
+    INDEX_FILE = "download_index.sqlite"
+    # 下载文件夹最多占用的空间（MB），超出时按最近最少使用删除旧图片；0 表示不限制
+    CACHE_MAX_MB = 0
+    # 增量同步状态文件：按 'Newest' 排序时只获取上次运行之后的新图片
+    STATE_FILE = "sync_state.json"
     
     # --- 脚本执行区域 (无需修改) ---
     
@@ -117,24 +307,49 @@ def main():
         return
 
     os.makedirs(DOWNLOAD_FOLDER, exist_ok=True)
+    SESSION.headers["Authorization"] = f"Bearer {API_KEY}"
 
-    images_to_download = get_all_creator_images(API_KEY, CREATOR_USERNAME, nsfw=NSFW_FILTER, sort=SORT_ORDER)
+    sync_state = load_sync_state(STATE_FILE)
+    state_key = f"{CREATOR_USERNAME}_{NSFW_FILTER}_{SORT_ORDER}"
+    state = dict(sync_state.get(state_key, {}))
+    images_to_download = get_all_creator_images(CREATOR_USERNAME, nsfw=NSFW_FILTER, sort=SORT_ORDER, state=state)
 
     if not images_to_download:
-        print("未能找到该创作者的任何图片，或 API 请求失败。")
+        print("没有需要下载的新图片，或 API 请求失败。")
         return
         
-    print(f"\n共找到 {len(images_to_download)} 张图片，开始下载...")
+    print(f"\n共找到 {len(images_to_download)} 张图片，开始使用 {MAX_WORKERS} 个线程下载...")
+    jobs = build_download_jobs(images_to_download, DOWNLOAD_FOLDER)
     
-    success_count = 0
-    fail_count = 0
+    # 用令牌桶限制总请求速率（友好限速，避免IP被封），而不是逐张串行 sleep
+    limiter = RateLimiter(DOWNLOAD_RATE)
+    index = DownloadIndex(INDEX_FILE)
+    # 一次性列出已有文件，代替每张图片一次 os.path.exists 系统调用
+    existing = {entry.name for entry in os.scandir(DOWNLOAD_FOLDER)}
     
-    for image in images_to_download:
-        if download_image(image, DOWNLOAD_FOLDER):
-            success_count += 1
-        else:
-            fail_count += 1
-        time.sleep(0.5) # 友好延时，避免IP被封
+    try:
+        # tqdm 在后台按固定频率刷新进度条，代替每张图片一次 print
+        results = thread_map(
+            partial(download_image, limiter=limiter, index=index, existing=existing),
+            jobs,
+            max_workers=MAX_WORKERS,
+            smoothing=0.1,
+            mininterval=0.2,
+        )
+        success_count = sum(1 for ok in results if ok)
+        fail_count = len(images_to_download) - success_count
+
+        if CACHE_MAX_MB > 0:
+            evicted = index.evict(CACHE_MAX_MB * 1024 * 1024)
+            if evicted:
+                print(f"超出磁盘占用上限，已删除 {evicted} 张最久未使用的图片。")
+    finally:
+        index.close()
+
+    # 全部成功后才记录同步位置，失败的图片下次运行还会重新获取
+    if fail_count == 0:
+        sync_state[state_key] = state
+        save_sync_state(STATE_FILE, sync_state)
 
     print("\n--- 下载完成 ---")
     print(f"成功下载: {success_count} 张")
@@ -5,20 +5,35 @@ import argparse
 import time
 import zipfile
 import io
+import multiprocessing
+import itertools
+import queue
+import hashlib
+import sqlite3
 from PIL import Image
-from concurrent.futures import ThreadPoolExecutor, as_completed
-from threading import Lock
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, as_completed
+from threading import Lock, Thread
 
 # --- 全局变量 ---
 API_BASE_URL = "https://civitai.com/api/v1/images"
-download_count = 0
+# 已处理图片的计数器：next() 在 CPython 中是原子操作，多线程取号无需加锁
+progress_counter = itertools.count(1)
 total_images = 0
-progress_lock = Lock()
+# 进度消息队列：由单独的报告线程批量输出
+report_queue = queue.SimpleQueue()
+REPORT_BATCH = 16
+zip_lock = Lock()
+# 所有线程共享的 HTTP 会话，复用 keep-alive 连接，避免每次请求重新进行 TCP/TLS 握手
+SESSION = requests.Session()
 
 # 扫描轮数与下载重试
 SCAN_PASSES = 3
 DOWNLOAD_RETRIES = 3
 DOWNLOAD_RETRY_DELAY = 2  # 秒
+# 翻页请求 API 的默认速率上限（次/秒）；0 表示不限速，翻页之间不等待
+API_RATE = 0
 
 def setup_arguments():
     """设置所有命令行参数"""
@@ -50,11 +65,132 @@ def setup_arguments():
                         help=f"How many times to rescan the image list and take union (default: {SCAN_PASSES}).")
     parser.add_argument("--download-retries", type=int, default=DOWNLOAD_RETRIES, metavar="[0-10]", choices=range(0, 11),
                         help=f"Retries per image download on failure (default: {DOWNLOAD_RETRIES}).")
+    parser.add_argument("--api-rate", type=float, default=API_RATE, metavar="N",
+                        help=f"Max API page requests per second (0 = no limit, default: {API_RATE}).")
+    parser.add_argument("--dl-rate", type=float, default=0, metavar="N",
+                        help="Max image download requests per second across all threads (0 = no limit, default).")
+    parser.add_argument("--cache-max-mb", type=int, default=0, metavar="MB",
+                        help="Cap disk usage of downloaded JPEGs; least recently used files are deleted (0 = no limit, default).")
     parser.add_argument("--no-zip", action='store_true', help="Do not create a zip archive. Keep individual JPEG files.")
 
     return parser.parse_args()
 
-def fetch_image_metadata_once(params, pass_index):
+def report(message):
+    """把进度消息交给报告线程输出，工作线程不直接写 stdout，也不用争抢锁。"""
+    report_queue.put(message)
+
+def reporter():
+    """报告线程：批量取出进度消息，每批（最多 REPORT_BATCH 条）只写一次 stdout。收到 None 时退出。"""
+    while True:
+        lines = [report_queue.get()]
+        while len(lines) < REPORT_BATCH:
+            try:
+                lines.append(report_queue.get_nowait())
+            except queue.Empty:
+                break
+        done = None in lines
+        lines = [line for line in lines if line is not None]
+        if lines:
+            print("\n".join(lines), flush=True)
+        if done:
+            return
+
+def start_reporter():
+    """启动报告线程，返回一个用于排空剩余消息并结束该线程的函数。"""
+    thread = Thread(target=reporter, daemon=True)
+    thread.start()
+
+    def stop():
+        report_queue.put(None)
+        thread.join()
+    return stop
+
+def configure_session(pool_size):
+    """为共享会话挂载连接池（大小与线程数一致）和临时错误重试策略。"""
+    SESSION.mount("https://", HTTPAdapter(
+        pool_connections=pool_size,
+        pool_maxsize=pool_size,
+        max_retries=Retry(total=3, backoff_factor=0.3, status_forcelist=[429, 500, 502, 503, 504]),
+    ))
+
+class DownloadIndex:
+    """
+    本地下载索引（SQLite）：按图片ID记录文件路径、大小和 sha256。
+    Civitai 的图片按 ID 不可变：再次运行时索引中记录的文件仍存在即直接跳过，无需任何网络请求，
+    也不受文件命名方式变化的影响。
+    """
+    def __init__(self, db_path):
+        self.conn = sqlite3.connect(db_path, check_same_thread=False)
+        self.lock = Lock()
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS images ("
+            "image_id INTEGER PRIMARY KEY, path TEXT, size INTEGER, sha256 TEXT, last_access REAL)"
+        )
+
+    def lookup(self, image_id):
+        """返回该图片ID上次保存的文件路径；未下载过则返回 None。"""
+        with self.lock:
+            row = self.conn.execute("SELECT path FROM images WHERE image_id = ?", (image_id,)).fetchone()
+        return row[0] if row else None
+
+    def record(self, image_id, path, size, sha256):
+        """下载完成后记录文件路径、大小和 sha256。"""
+        with self.lock:
+            # 显式列出列名，旧版本创建的索引（带 etag / last_modified 列）也能继续使用
+            self.conn.execute(
+                "INSERT OR REPLACE INTO images (image_id, path, size, sha256, last_access) VALUES (?, ?, ?, ?, ?)",
+                (image_id, path, size, sha256, time.time()),
+            )
+
+    def touch(self, image_id):
+        """跳过已下载的图片时刷新最近访问时间，供 LRU 淘汰使用。"""
+        with self.lock:
+            self.conn.execute("UPDATE images SET last_access = ? WHERE image_id = ?", (time.time(), image_id))
+
+    def evict(self, max_bytes):
+        """总大小超过 max_bytes 时，按最近最少使用的顺序删除旧文件，返回删除的数量。"""
+        removed = 0
+        with self.lock:
+            total = self.conn.execute("SELECT COALESCE(SUM(size), 0) FROM images").fetchone()[0]
+            rows = self.conn.execute("SELECT image_id, path, size FROM images ORDER BY last_access").fetchall()
+            for image_id, path, size in rows:
+                if total <= max_bytes:
+                    break
+                if os.path.exists(path):
+                    os.remove(path)
+                self.conn.execute("DELETE FROM images WHERE image_id = ?", (image_id,))
+                total -= size
+                removed += 1
+        return removed
+
+    def close(self):
+        with self.lock:
+            self.conn.commit()
+            self.conn.close()
+
+class RateLimiter:
+    """
+    令牌桶限速器：按 rate（次/秒）补充令牌，最多积攒 capacity 个（默认等于 rate），多个线程共享。
+    只在超出速率时才等待，取代每次请求后固定的 sleep。
+    """
+    def __init__(self, rate, capacity=None):
+        self.rate = rate
+        self.capacity = capacity or rate
+        self.tokens = self.capacity
+        self.last = time.monotonic()
+        self.lock = Lock()
+
+    def acquire(self):
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.capacity, self.tokens + (now - self.last) * self.rate)
+            self.last = now
+            wait = (1 - self.tokens) / self.rate if self.tokens < 1 else 0
+            self.tokens -= 1
+        if wait > 0:
+            time.sleep(wait)
+
+def fetch_image_metadata_once(params, pass_index, limiter):
     """单次遍历所有页面，获取图片元数据。"""
     print(f"  --- 第 {pass_index} 轮扫描 ---")
     images_by_id = {}
@@ -63,7 +199,9 @@ def fetch_image_metadata_once(params, pass_index):
 
     while next_url:
         try:
-            response = requests.get(next_url, params=params if is_first_page else None, timeout=20)
+            if limiter:
+                limiter.acquire()
+            response = SESSION.get(next_url, params=params if is_first_page else None, timeout=20)
             response.raise_for_status()
             data = response.json()
             is_first_page = False
@@ -87,32 +225,51 @@ def fetch_image_metadata_once(params, pass_index):
     print(f"  [*] 第 {pass_index} 轮扫描结束，本轮 {len(images_by_id)} 张。")
     return images_by_id
 
-def fetch_all_image_metadata(params, scan_passes=SCAN_PASSES):
+def fetch_all_image_metadata(params, scan_passes=SCAN_PASSES, api_rate=API_RATE):
     """
     第一阶段：多轮扫描列表页，对结果取并集，降低漏扫概率。
     """
     print(f"[1/3] 正在获取所有图片信息（共扫描 {scan_passes} 轮，取并集）...")
     merged = {}
+    # 指定 --api-rate 时各轮共用一个令牌桶限制翻页速率；遇到 429 时会话的重试策略会按 Retry-After 等待
+    limiter = RateLimiter(api_rate) if api_rate > 0 else None
 
     for i in range(1, scan_passes + 1):
-        pass_map = fetch_image_metadata_once(params, i)
+        pass_map = fetch_image_metadata_once(params, i, limiter)
         before = len(merged)
         merged.update(pass_map)
         added = len(merged) - before
         print(f"  [*] 并集更新: 新增 {added} 张，当前总计 {len(merged)} 张。")
-        if i < scan_passes:
-            time.sleep(1)
 
     all_images = list(merged.values())
     print(f"[*] 多轮扫描完成，并集共 {len(all_images)} 张图片。\n")
     return all_images
 
-def process_and_download_image(image_info, output_path, jpeg_quality, max_retries=DOWNLOAD_RETRIES):
+def init_encoder():
+    """编码进程池的初始化函数：每个进程启动时预先注册 Pillow 的全部格式插件，之后的编码任务只剩纯计算。"""
+    Image.init()
+
+def encode_jpeg(raw, jpeg_quality):
     """
-    下载、转换并保存单张图片。失败时自动重试。
+    将下载到的原始图片字节解码并重新编码为 JPEG，返回编码后的字节。
+    纯 CPU 计算，在进程池中执行，绕开 GIL 以利用所有 CPU 核心。
     """
-    global download_count
+    img = Image.open(io.BytesIO(raw))
+    if img.mode in ('RGBA', 'P'):
+        img = img.convert('RGB')
+    elif img.mode != 'RGB':
+        img = img.convert('RGB')
     
+    buf = io.BytesIO()
+    img.save(buf, 'jpeg', quality=jpeg_quality, optimize=False, progressive=False)
+    return buf.getvalue()
+
+def process_and_download_image(image_info, output_path, jpeg_quality, encoder, max_retries=DOWNLOAD_RETRIES, index=None, limiter=None, zf=None):
+    """
+    下载、转换并保存单张图片。失败时自动重试。
+    传入 index 时，索引中记录的文件仍存在的图片直接跳过，不发网络请求。
+    传入 zf 时直接写入该 ZIP 压缩包，否则保存为 output_path 下的单独文件。
+    """
     image_id = image_info.get('id')
     image_url = image_info.get('url')
     username = image_info.get('username', 'unknown')
@@ -123,73 +280,68 @@ def process_and_download_image(image_info, output_path, jpeg_quality, max_retrie
     last_error = None
     for attempt in range(1, max_retries + 2):  # 1 次首次 + max_retries 次重试
         try:
-            response = requests.get(image_url, timeout=30)
-            response.raise_for_status()
+            jpeg_filename = f"{username}_{image_id}.jpeg"
+            jpeg_filepath = os.path.join(output_path, jpeg_filename)
+            # 图片按 ID 不可变，已下载过且文件仍在即跳过，不发请求也不占用限速令牌
+            if index:
+                old_path = index.lookup(image_id)
+                if old_path and os.path.exists(old_path):
+                    index.touch(image_id)
+                    report(f"  [{next(progress_counter)}/{total_images}] = 已下载过，跳过 {jpeg_filename}")
+                    return None
+            if limiter:
+                limiter.acquire()
             
-            image_bytes = io.BytesIO(response.content)
-            img = Image.open(image_bytes)
+            # 流式请求后一次性从连接读完整个响应体，避免 response.content 分块读取再拼接的额外拷贝
+            with SESSION.get(image_url, stream=True, timeout=30) as response:
+                response.raise_for_status()
+                raw = response.raw.read(decode_content=True)
             
-            if img.mode in ('RGBA', 'P'):
-                img = img.convert('RGB')
-            elif img.mode != 'RGB':
-                img = img.convert('RGB')
+            # Image.open 只解析文件头；源图已是 RGB JPEG 时直接写入原始字节，省去一次解码+编码
+            img = Image.open(io.BytesIO(raw))
+            if img.format == 'JPEG' and img.mode == 'RGB':
+                jpeg_bytes = raw
+            else:
+                jpeg_bytes = encoder.submit(encode_jpeg, raw, jpeg_quality).result()
             
-            jpeg_filename = f"{username}_{image_id}.jpeg"
-            jpeg_filepath = os.path.join(output_path, jpeg_filename)
-            img.save(jpeg_filepath, 'jpeg', quality=jpeg_quality)
+            if zf is not None:
+                # 锁只覆盖写入压缩包这一步，下载和编码仍然完全并行
+                with zip_lock:
+                    zf.writestr(jpeg_filename, jpeg_bytes)
+            else:
+                with open(jpeg_filepath, 'wb') as f:
+                    f.write(jpeg_bytes)
+            if index:
+                index.record(image_id, jpeg_filepath, len(jpeg_bytes), hashlib.sha256(jpeg_bytes).hexdigest())
 
-            with progress_lock:
-                download_count += 1
-                print(f"  [{download_count}/{total_images}] ✓ 下载并转换为 {jpeg_filename}")
+            report(f"  [{next(progress_counter)}/{total_images}] ✓ 下载并转换为 {jpeg_filename}")
             
             return None
         except Exception as e:
             last_error = e
             if attempt <= max_retries:
-                print(f"  ↻ 图片ID {image_id} 第 {attempt} 次失败，{DOWNLOAD_RETRY_DELAY}s 后重试: {e}")
+                report(f"  ↻ 图片ID {image_id} 第 {attempt} 次失败，{DOWNLOAD_RETRY_DELAY}s 后重试: {e}")
                 time.sleep(DOWNLOAD_RETRY_DELAY * attempt)
             else:
                 break
 
-    return f"  [{download_count}/{total_images}] ✗ 处理图片ID {image_id} 失败（已重试 {max_retries} 次）: {last_error}"
-
-def create_zip_archive(source_dir, zip_filepath):
-    """将目录中的所有JPEG文件压缩成一个zip文件。"""
-    print("\n[3/3] 正在创建 ZIP 压缩包...")
-    try:
-        with zipfile.ZipFile(zip_filepath, 'w', zipfile.ZIP_DEFLATED) as zf:
-            for root, _, files in os.walk(source_dir):
-                for file in files:
-                    if file.endswith('.jpeg'):
-                        filepath = os.path.join(root, file)
-                        zf.write(filepath, arcname=file)
-        
-        print(f"[*] 成功创建压缩包: {zip_filepath}")
-        
-        print("[*] 正在清理临时文件...")
-        for file in os.listdir(source_dir):
-            if file.endswith('.jpeg'):
-                os.remove(os.path.join(source_dir, file))
-        os.rmdir(source_dir)
-        
-    except Exception as e:
-        print(f"  ✗ 创建ZIP或清理文件时出错: {e}")
-
+    return f"  [{next(progress_counter)}/{total_images}] ✗ 处理图片ID {image_id} 失败（已重试 {max_retries} 次）: {last_error}"
 
 def main():
     """主执行函数"""
     global total_images
     args = setup_arguments()
+    configure_session(args.threads)
     
     temp_image_dir = os.path.join(args.output_dir, args.username)
-    os.makedirs(temp_image_dir, exist_ok=True)
+    os.makedirs(args.output_dir, exist_ok=True)
     
     api_params = {"username": args.username, "limit": args.limit, "sort": args.sort, "period": args.period}
     if args.nsfw != "All":
         api_params["nsfw"] = args.nsfw
 
     # 1. 多轮扫描并取并集
-    all_image_data = fetch_all_image_metadata(api_params, scan_passes=args.scan_passes)
+    all_image_data = fetch_all_image_metadata(api_params, scan_passes=args.scan_passes, api_rate=args.api_rate)
     total_images = len(all_image_data)
     if total_images == 0:
         print("[*] 没有找到任何图片，程序退出。")
@@ -197,30 +349,61 @@ def main():
 
     # 2. 使用线程池进行下载和处理（带重试）
     print(f"[2/3] 开始使用 {args.threads} 个线程进行下载和转换（失败重试 {args.download_retries} 次）...")
-    with ThreadPoolExecutor(max_workers=args.threads) as executor:
-        futures = [
-            executor.submit(
-                process_and_download_image,
-                img_data,
-                temp_image_dir,
-                args.jpeg_quality,
-                args.download_retries,
-            )
-            for img_data in all_image_data
-        ]
-        
-        for future in as_completed(futures):
-            result = future.result()
-            if result:
-                print(result)
-
-    print("\n[*] 所有图片处理完成。")
-    
-    # 3. 创建ZIP压缩包
+    # 准备输出：需要ZIP压缩包时预先打开，各线程直接把JPEG写进去，不再经过临时目录
+    # JPEG 本身已是压缩数据，DEFLATE 几乎无法再缩小体积，使用 ZIP_STORED 省去压缩开销
+    # 下载索引依赖磁盘上保留的文件，只在 --no-zip 模式下使用
+    zf = None
+    index = None
     if not args.no_zip:
         zip_filename = f"civitai_{args.username}_images.zip"
         zip_filepath = os.path.join(args.output_dir, zip_filename)
-        create_zip_archive(temp_image_dir, zip_filepath)
+        zf = zipfile.ZipFile(zip_filepath, 'w', zipfile.ZIP_STORED, allowZip64=True)
+    else:
+        os.makedirs(temp_image_dir, exist_ok=True)
+        index = DownloadIndex(os.path.join(args.output_dir, "download_index.sqlite"))
+    limiter = RateLimiter(args.dl_rate) if args.dl_rate > 0 else None
+    stop_reporter = start_reporter()
+    try:
+        # 下载线程负责网络 I/O，JPEG 重新编码交给进程池并行执行
+        # 进程池在下载线程运行时才启动工作进程，fork 会把其他线程持有的锁原样复制进子进程；
+        # 改用 forkserver 从干净的服务进程派生（Windows 不支持 forkserver，退回 spawn）
+        start_method = "forkserver" if "forkserver" in multiprocessing.get_all_start_methods() else "spawn"
+        with ProcessPoolExecutor(max_workers=os.cpu_count(), initializer=init_encoder, mp_context=multiprocessing.get_context(start_method)) as encoder, ThreadPoolExecutor(max_workers=args.threads) as executor:
+            futures = [
+                executor.submit(
+                    process_and_download_image,
+                    img_data,
+                    temp_image_dir,
+                    args.jpeg_quality,
+                    encoder,
+                    args.download_retries,
+                    index,
+                    limiter,
+                    zf,
+                )
+                for img_data in all_image_data
+            ]
+            
+            for future in as_completed(futures):
+                result = future.result()
+                if result:
+                    report(result)
+
+        if index and args.cache_max_mb > 0:
+            evicted = index.evict(args.cache_max_mb * 1024 * 1024)
+            if evicted:
+                report(f"[*] 超出磁盘占用上限，已删除 {evicted} 张最久未使用的图片。")
+    finally:
+        stop_reporter()
+        if zf is not None:
+            zf.close()
+        if index:
+            index.close()
+
+    print("\n[*] 所有图片处理完成。")
+    
+    if zf is not None:
+        print(f"[3/3] 已成功写入压缩包: {zip_filepath}")
     else:
         print("[*] 已跳过创建ZIP压缩包。JPEG文件保存在 " + temp_image_dir)
 
@@ -5,15 +5,35 @@ import argparse
 import time
 import zipfile
 import io
+import multiprocessing
+import itertools
+import queue
 from PIL import Image
-from concurrent.futures import ThreadPoolExecutor, as_completed
-from threading import Lock
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from threading import Lock, BoundedSemaphore, Thread
 
 # --- 全局变量 ---
 API_BASE_URL = "https://civitai.com/api/v1/images"
-download_count = 0
+# 已处理图片的计数器：next() 在 CPython 中是原子操作，多线程取号无需加锁
+progress_counter = itertools.count(1)
 total_images = 0
-progress_lock = Lock()
+# 进度消息队列：由单独的报告线程批量输出
+report_queue = queue.SimpleQueue()
+REPORT_BATCH = 16
+zip_lock = Lock()
+# 翻页请求 API 的默认速率上限（次/秒）；0 表示不限速，翻页之间不等待
+API_RATE = 0
+# 所有线程共享的 HTTP 会话，复用 keep-alive 连接，避免每次请求重新进行 TCP/TLS 握手
+SESSION = requests.Session()
+
+def non_negative_int(value):
+    """argparse 的 type 函数：只接受大于等于 0 的整数。"""
+    number = int(value)
+    if number < 0:
+        raise argparse.ArgumentTypeError(f"must be a non-negative integer, got {value}")
+    return number
 
 def setup_arguments():
     """设置所有命令行参数"""
@@ -45,23 +65,92 @@ def setup_arguments():
                         help="Number of concurrent download threads (default: 10).")
     parser.add_argument("--jpeg-quality", type=int, default=85, metavar="[1-95]", choices=range(1, 96),
                         help="Quality for JPEG conversion (1-95, default: 85).")
+    parser.add_argument("--api-rate", type=float, default=API_RATE, metavar="N",
+                        help=f"Max API page requests per second (0 = no limit, default: {API_RATE}).")
+    parser.add_argument("--dl-rate", type=float, default=0, metavar="N",
+                        help="Max image download requests per second across all threads (0 = no limit, default).")
+    parser.add_argument("--max-dim", type=non_negative_int, default=0, metavar="PIXELS",
+                        help="Downscale images so the longest side is at most PIXELS (0 keeps full size, default: 0).")
     parser.add_argument("--no-zip", action='store_true', help="Do not create a zip archive. Keep individual JPEG files.")
 
     return parser.parse_args()
 
-def fetch_all_image_metadata(params):
+def report(message):
+    """把进度消息交给报告线程输出，工作线程不直接写 stdout，也不用争抢锁。"""
+    report_queue.put(message)
+
+def reporter():
+    """报告线程：批量取出进度消息，每批（最多 REPORT_BATCH 条）只写一次 stdout。收到 None 时退出。"""
+    while True:
+        lines = [report_queue.get()]
+        while len(lines) < REPORT_BATCH:
+            try:
+                lines.append(report_queue.get_nowait())
+            except queue.Empty:
+                break
+        done = None in lines
+        lines = [line for line in lines if line is not None]
+        if lines:
+            print("\n".join(lines), flush=True)
+        if done:
+            return
+
+def start_reporter():
+    """启动报告线程，返回一个用于排空剩余消息并结束该线程的函数。"""
+    thread = Thread(target=reporter, daemon=True)
+    thread.start()
+
+    def stop():
+        report_queue.put(None)
+        thread.join()
+    return stop
+
+def configure_session(pool_size):
+    """为共享会话挂载连接池（大小与线程数一致）和临时错误重试策略。"""
+    SESSION.mount("https://", HTTPAdapter(
+        pool_connections=pool_size,
+        pool_maxsize=pool_size,
+        max_retries=Retry(total=3, backoff_factor=0.3, status_forcelist=[429, 500, 502, 503, 504]),
+    ))
+
+class RateLimiter:
+    """
+    令牌桶限速器：按 rate（次/秒）补充令牌，最多积攒 capacity 个（默认等于 rate），多个线程共享。
+    只在超出速率时才等待，取代每次请求后固定的 sleep。
+    """
+    def __init__(self, rate, capacity=None):
+        self.rate = rate
+        self.capacity = capacity or rate
+        self.tokens = self.capacity
+        self.last = time.monotonic()
+        self.lock = Lock()
+
+    def acquire(self):
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.capacity, self.tokens + (now - self.last) * self.rate)
+            self.last = now
+            wait = (1 - self.tokens) / self.rate if self.tokens < 1 else 0
+            self.tokens -= 1
+        if wait > 0:
+            time.sleep(wait)
+
+def iter_image_metadata(params, api_rate=API_RATE):
     """
-    第一阶段：遍历所有页面，获取所有图片的元数据（URL、ID等）。
-    这是为了预先知道总图片数，以便显示进度。
+    第一阶段：逐页遍历 API，每取到一页就立即逐条产出图片元数据（URL、ID等），
+    让下载可以在后续页面仍在获取时就开始，而不必等全部列表取完。
     """
-    print("[1/3] 正在获取所有图片信息...")
-    all_images = []
+    found = 0
     next_url = API_BASE_URL
     is_first_page = True
+    # 指定 --api-rate 时用令牌桶限制翻页速率；遇到 429 时会话的重试策略会按 Retry-After 等待
+    limiter = RateLimiter(api_rate) if api_rate > 0 else None
 
     while next_url:
         try:
-            response = requests.get(next_url, params=params if is_first_page else None, timeout=20)
+            if limiter:
+                limiter.acquire()
+            response = SESSION.get(next_url, params=params if is_first_page else None, timeout=20)
             response.raise_for_status()
             data = response.json()
             is_first_page = False
@@ -70,23 +159,46 @@ def fetch_all_image_metadata(params):
             if not items:
                 break
             
-            all_images.extend(items)
-            print(f"  > 已找到 {len(all_images)} 张图片...")
+            found += len(items)
+            report(f"  > 已找到 {found} 张图片...")
             
             next_url = data.get('metadata', {}).get('nextPage')
         except requests.exceptions.RequestException as e:
-            print(f"  ✗ API请求失败: {e}")
+            report(f"  ✗ API请求失败: {e}")
             break
-            
-    print(f"[*] 总共找到 {len(all_images)} 张图片。\n")
-    return all_images
+        
+        yield from items
+
+def init_encoder():
+    """编码进程池的初始化函数：每个进程启动时预先注册 Pillow 的全部格式插件，之后的编码任务只剩纯计算。"""
+    Image.init()
 
-def process_and_download_image(image_info, output_path, jpeg_quality):
+def encode_jpeg(raw, jpeg_quality, max_dim=0):
     """
-    下载、转换并保存单张图片。此函数将在多线程中执行。
+    将下载到的原始图片字节解码并重新编码为 JPEG，返回编码后的字节。
+    max_dim 大于 0 时将图片等比缩小到最长边不超过 max_dim。
+    纯 CPU 计算，在进程池中执行，绕开 GIL 以利用所有 CPU 核心。
     """
-    global download_count
+    img = Image.open(io.BytesIO(raw))
+    # 需要缩小时把目标尺寸告诉 JPEG 解码器，让它在 IDCT 阶段就按 1/2、1/4、1/8 缩小解码；其他格式忽略此调用
+    if max_dim:
+        img.draft('RGB', (max_dim, max_dim))
     
+    if img.mode == 'RGBA':
+        img = img.convert('RGB')
+    
+    if max_dim:
+        img.thumbnail((max_dim, max_dim), Image.Resampling.LANCZOS)
+    
+    buf = io.BytesIO()
+    img.save(buf, 'jpeg', quality=jpeg_quality, optimize=False, progressive=False)
+    return buf.getvalue()
+
+def process_and_download_image(image_info, output_path, jpeg_quality, encoder, zf=None, max_dim=0, limiter=None):
+    """
+    下载、转换并保存单张图片。此函数将在多线程中执行。
+    传入 zf 时直接写入该 ZIP 压缩包，否则保存为 output_path 下的单独文件。
+    """
     image_id = image_info.get('id')
     image_url = image_info.get('url')
     username = image_info.get('username', 'unknown')
@@ -95,57 +207,44 @@ def process_and_download_image(image_info, output_path, jpeg_quality):
         return f"信息不完整，跳过: {image_info}"
 
     try:
-        response = requests.get(image_url, timeout=30)
-        response.raise_for_status()
-        
-        image_bytes = io.BytesIO(response.content)
-        img = Image.open(image_bytes)
-        
-        if img.mode == 'RGBA':
-            img = img.convert('RGB')
+        if limiter:
+            limiter.acquire()
+        # 流式请求后一次性从连接读完整个响应体，避免 response.content 分块读取再拼接的额外拷贝
+        with SESSION.get(image_url, stream=True, timeout=30) as response:
+            response.raise_for_status()
+            raw = response.raw.read(decode_content=True)
         
         jpeg_filename = f"{username}_{image_id}.jpeg"
-        jpeg_filepath = os.path.join(output_path, jpeg_filename)
-        img.save(jpeg_filepath, 'jpeg', quality=jpeg_quality)
-
-        with progress_lock:
-            download_count += 1
-            print(f"  [{download_count}/{total_images}] ✓ 下载并转换为 {jpeg_filename}")
         
-        return None # 表示成功
-    except Exception as e:
-        return f"  [{download_count}/{total_images}] ✗ 处理图片ID {image_id} 失败: {e}"
+        # Image.open 只解析文件头；源图已是无需缩小的 RGB JPEG 时直接使用原始字节，省去一次解码+编码
+        img = Image.open(io.BytesIO(raw))
+        if img.format == 'JPEG' and img.mode == 'RGB' and (not max_dim or max(img.size) <= max_dim):
+            jpeg_bytes = raw
+        else:
+            jpeg_bytes = encoder.submit(encode_jpeg, raw, jpeg_quality, max_dim).result()
 
-def create_zip_archive(source_dir, zip_filepath):
-    """将目录中的所有JPEG文件压缩成一个zip文件。"""
-    print("\n[3/3] 正在创建 ZIP 压缩包...")
-    try:
-        with zipfile.ZipFile(zip_filepath, 'w', zipfile.ZIP_DEFLATED) as zf:
-            for root, _, files in os.walk(source_dir):
-                for file in files:
-                    if file.endswith('.jpeg'):
-                        filepath = os.path.join(root, file)
-                        zf.write(filepath, arcname=file)
-        
-        print(f"[*] 成功创建压缩包: {zip_filepath}")
-        
-        print("[*] 正在清理临时文件...")
-        for file in os.listdir(source_dir):
-            if file.endswith('.jpeg'):
-                os.remove(os.path.join(source_dir, file))
-        os.rmdir(source_dir)
+        if zf is not None:
+            with zip_lock:
+                zf.writestr(jpeg_filename, jpeg_bytes)
+        else:
+            with open(os.path.join(output_path, jpeg_filename), 'wb') as f:
+                f.write(jpeg_bytes)
+
+        report(f"  [{next(progress_counter)}/{total_images}] ✓ 下载并转换为 {jpeg_filename}")
         
+        return None # 表示成功
     except Exception as e:
-        print(f"  ✗ 创建ZIP或清理文件时出错: {e}")
+        return f"  [{next(progress_counter)}/{total_images}] ✗ 处理图片ID {image_id} 失败: {e}"
 
 
 def main():
     """主执行函数"""
     global total_images
     args = setup_arguments()
+    configure_session(args.threads)
     
     temp_image_dir = os.path.join(args.output_dir, args.username)
-    os.makedirs(temp_image_dir, exist_ok=True)
+    os.makedirs(args.output_dir, exist_ok=True)
     
     # 准备API参数
     # <-- 修改：现在总是包含 nsfw 参数，因为 'All' 选项已移除
@@ -157,37 +256,65 @@ def main():
         "nsfw": args.nsfw
     }
 
-    # 1. 获取所有图片元数据
-    all_image_data = fetch_all_image_metadata(api_params)
-    original_count = len(all_image_data)
+    # 准备输出：需要ZIP压缩包时预先打开，各线程直接把JPEG写进去，不再经过临时目录
+    # JPEG 本身已是压缩数据，DEFLATE 几乎无法再缩小体积，使用 ZIP_STORED 省去压缩开销
+    zf = None
+    if not args.no_zip:
+        zip_filename = f"civitai_{args.username}_images.zip"
+        zip_filepath = os.path.join(args.output_dir, zip_filename)
+        zf = zipfile.ZipFile(zip_filepath, 'w', zipfile.ZIP_STORED, allowZip64=True)
+    else:
+        os.makedirs(temp_image_dir, exist_ok=True)
+
+    # 1. 逐页获取图片元数据
+    print("[1/3] 正在获取图片信息...")
+    image_data = iter_image_metadata(api_params, args.api_rate)
     
-    # <-- 新增：根据 --image-count 参数截取图片列表
-    if args.image_count > 0 and args.image_count < original_count:
-        print(f"[*] 用户指定下载前 {args.image_count} 张图片，将从总共 {original_count} 张中选取。")
-        all_image_data = all_image_data[:args.image_count]
+    # <-- 新增：根据 --image-count 参数截取图片列表（取够数量后不再请求后续页面）
+    if args.image_count > 0:
+        print(f"[*] 用户指定只下载前 {args.image_count} 张图片。")
+        image_data = itertools.islice(image_data, args.image_count)
+
+    # 2. 每取到一张图片的信息就立即提交给线程池下载和处理
+    print(f"[2/3] 边获取边使用 {args.threads} 个线程进行下载和转换...")
+    # 限制已提交但未完成的任务数，避免列表获取远快于下载时无限堆积
+    pending = BoundedSemaphore(args.threads * 4)
+    limiter = RateLimiter(args.dl_rate) if args.dl_rate > 0 else None
+
+    def on_done(future):
+        pending.release()
+        result = future.result()
+        if result:
+            report(result)
+
+    stop_reporter = start_reporter()
+    try:
+        # 下载线程负责网络 I/O，JPEG 重新编码交给进程池并行执行
+        # 进程池在下载线程运行时才启动工作进程，fork 会把其他线程持有的锁原样复制进子进程；
+        # 改用 forkserver 从干净的服务进程派生（Windows 不支持 forkserver，退回 spawn）
+        start_method = "forkserver" if "forkserver" in multiprocessing.get_all_start_methods() else "spawn"
+        with ProcessPoolExecutor(max_workers=os.cpu_count(), initializer=init_encoder, mp_context=multiprocessing.get_context(start_method)) as encoder, ThreadPoolExecutor(max_workers=args.threads) as executor:
+            for img_data in image_data:
+                pending.acquire()
+                total_images += 1
+                future = executor.submit(process_and_download_image, img_data, temp_image_dir, args.jpeg_quality, encoder, zf, args.max_dim, limiter)
+                future.add_done_callback(on_done)
+    finally:
+        stop_reporter()
+        if zf is not None:
+            zf.close()
 
-    total_images = len(all_image_data)
+    print(f"[*] 总共找到 {total_images} 张图片。")
     if total_images == 0:
+        if zf is not None:
+            os.remove(zip_filepath)
         print("[*] 没有找到任何图片，程序退出。")
         return
 
-    # 2. 使用线程池进行下载和处理
-    print(f"[2/3] 开始使用 {args.threads} 个线程进行下载和转换...")
-    with ThreadPoolExecutor(max_workers=args.threads) as executor:
-        futures = [executor.submit(process_and_download_image, img_data, temp_image_dir, args.jpeg_quality) for img_data in all_image_data]
-        
-        for future in as_completed(futures):
-            result = future.result()
-            if result:
-                print(result)
-
     print("\n[*] 所有图片处理完成。")
     
-    # 3. 创建ZIP压缩包 (如果需要)
-    if not args.no_zip:
-        zip_filename = f"civitai_{args.username}_images.zip"
-        zip_filepath = os.path.join(args.output_dir, zip_filename)
-        create_zip_archive(temp_image_dir, zip_filepath)
+    if zf is not None:
+        print(f"[3/3] 已成功写入压缩包: {zip_filepath}")
     else:
         print("[*] 已跳过创建ZIP压缩包。JPEG文件保存在 " + temp_image_dir)
 
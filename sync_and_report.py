@@ -1,5 +1,6 @@
 # sync_and_report.py
 import os
+import sys
 import json
 import argparse
 from datetime import datetime
@@ -7,20 +8,48 @@ import requests
 import time
 import zipfile
 import io
+import multiprocessing
 from PIL import Image
-from concurrent.futures import ThreadPoolExecutor, as_completed
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, as_completed
 from threading import Lock
+from tqdm import tqdm
+
+# 清单可能有数万条记录，优先使用 C 实现的 orjson 读写；未安装时回退到标准库 json
+try:
+    import orjson
+except ImportError:
+    orjson = None
 
 API_BASE_URL = "https://civitai.com/api/v1/images"
-download_progress = {"count": 0, "total": 0}
-progress_lock = Lock()
+# ZipFile 不是线程安全的，多个下载线程写入同一个压缩包时需要加锁
+zip_lock = Lock()
+# --zip-compression 的取值；JPEG 已是压缩格式，默认 stored 只打包不再压缩
+ZIP_COMPRESSION = {"stored": zipfile.ZIP_STORED, "deflate": zipfile.ZIP_DEFLATED}
+# 所有线程共享的 HTTP 会话，复用 keep-alive 连接，避免每次请求重新进行 TCP/TLS 握手
+SESSION = requests.Session()
+
+def configure_session(pool_size):
+    """为共享会话挂载连接池（大小与线程数一致，线程不会额外建连）和临时错误重试策略。"""
+    SESSION.mount("https://", HTTPAdapter(
+        pool_connections=pool_size,
+        pool_maxsize=pool_size,
+        max_retries=Retry(total=3, backoff_factor=0.5, status_forcelist=[429, 500, 502, 503, 504]),
+    ))
 
-def fetch_all_image_metadata(params):
-    """获取指定创作者的所有图片元数据。"""
+def fetch_all_image_metadata(params, known_ids=None):
+    """
+    获取指定创作者的所有图片元数据。
+    传入 known_ids 时（要求按 Newest 排序，结果从新到旧）遇到第一张已知图片的页面即停止翻页，
+    此后的页面只会是清单里已有的旧图片。
+    返回 (图片列表, 是否完整)：到达最后一页或已知图片时为 True，中途请求失败时为 False。
+    """
     print("[1/4] 正在从 Civitai API 获取所有图片元数据...")
     all_images = []
     next_url = API_BASE_URL
     is_first_page = True
+    completed = False
 
     while next_url:
         try:
@@ -28,123 +57,156 @@ def fetch_all_image_metadata(params):
             request_url = next_url if not is_first_page else f"{next_url}?{'&'.join([f'{k}={v}' for k, v in params.items()])}"
             print(f"  > Fetching: {request_url}")
             
-            response = requests.get(next_url, params=params if is_first_page else None, timeout=20)
+            response = SESSION.get(next_url, params=params if is_first_page else None, timeout=20)
             response.raise_for_status()
             data = response.json()
             is_first_page = False
             
             items = data.get('items', [])
             if not items:
+                completed = True
                 break
             
             all_images.extend(items)
             print(f"  > 已找到 {len(all_images)} 张图片...")
             
+            if known_ids and any(item['id'] in known_ids for item in items):
+                print("  > 已到达上次同步过的图片，停止翻页。")
+                completed = True
+                break
+            
             next_url = data.get('metadata', {}).get('nextPage')
+            if not next_url:
+                completed = True
         except requests.exceptions.RequestException as e:
             print(f"  ✗ API请求失败: {e}")
             break
             
     print(f"[*] API 查询完成，总共找到 {len(all_images)} 张图片。\n")
-    return all_images
+    return all_images, completed
 
-def download_and_convert_image(image_info, output_path, jpeg_quality):
-    """下载、转换并保存单张图片。"""
-    global download_progress
+def init_encoder():
+    """编码进程池的初始化函数：每个进程启动时预先注册 Pillow 的全部格式插件，之后的编码任务只剩纯计算。"""
+    Image.init()
+
+def encode_jpeg(raw, jpeg_quality, jpeg_optimize=False):
+    """
+    将下载到的原始图片字节解码并重新编码为 JPEG，返回编码后的字节。
+    jpeg_optimize 为真时输出优化霍夫曼表的渐进式 JPEG，体积更小但编码更慢。
+    纯 CPU 计算，在进程池中执行，绕开 GIL 以利用所有 CPU 核心。
+    """
+    img = Image.open(io.BytesIO(raw))
+    if img.mode in ('RGBA', 'LA', 'P'):
+        # 带透明通道（或调色板）的源图合成到白色背景上，透明区域不会露出被隐藏的底色；
+        # 调色板图片先展开为 RGBA，以便同时处理其中的透明色
+        img = img.convert('RGBA')
+        background = Image.new('RGB', img.size, (255, 255, 255))
+        background.paste(img, mask=img.getchannel('A'))
+        img = background
+    elif img.mode not in ('RGB', 'L'):
+        img = img.convert('RGB')
     
+    buf = io.BytesIO()
+    # 显式使用 4:2:0 色度抽样（subsampling=2），与 libjpeg-turbo 的默认一致，色度平面只需编码四分之一
+    img.save(buf, 'jpeg', quality=jpeg_quality, subsampling=2,
+             optimize=jpeg_optimize, progressive=jpeg_optimize)
+    return buf.getvalue()
+
+def download_and_convert_image(image_info, zf, jpeg_quality, encoder, jpeg_optimize=False, passthrough_jpeg=False):
+    """
+    下载单张图片，交给编码进程池转换后直接写入压缩包 zf。下载在线程中执行，编码在 encoder 进程池中执行。
+    passthrough_jpeg 为真时源图若已是 JPEG 则原样写入，不再解码和重新编码。
+    返回 (文件名, 错误信息)：成功时错误信息为 None，失败时文件名为 None。
+    """
     image_id = image_info.get('id')
     image_url = image_info.get('url')
     username = image_info.get('username', 'unknown')
 
     if not image_id or not image_url:
-        return f"信息不完整，跳过: {image_info}"
+        return None, f"信息不完整，跳过: {image_info}"
 
     try:
-        response = requests.get(image_url, timeout=30)
-        response.raise_for_status()
-        
-        image_bytes = io.BytesIO(response.content)
-        img = Image.open(image_bytes)
+        # 流式请求后一次性从连接读完整个响应体，避免 response.content 分块读取再拼接的额外拷贝
+        with SESSION.get(image_url, stream=True, timeout=30) as response:
+            response.raise_for_status()
+            raw = response.raw.read(decode_content=True)
         
-        if img.mode == 'RGBA':
-            img = img.convert('RGB')
+        # 以 JPEG 的 SOI 标记开头即为 JPEG：直接使用原始字节，省去一次有损的解码+编码
+        if passthrough_jpeg and raw[:3] == b'\xff\xd8\xff':
+            jpeg_bytes = raw
+        else:
+            jpeg_bytes = encoder.submit(encode_jpeg, raw, jpeg_quality, jpeg_optimize).result()
         
         jpeg_filename = f"{username}_{image_id}.jpeg"
-        jpeg_filepath = os.path.join(output_path, jpeg_filename)
-        img.save(jpeg_filepath, 'jpeg', quality=jpeg_quality)
-
-        with progress_lock:
-            download_progress["count"] += 1
-            print(f"  [{download_progress['count']}/{download_progress['total']}] ✓ 下载并转换: {jpeg_filename}")
+        with zip_lock:
+            zf.writestr(jpeg_filename, jpeg_bytes)
         
-        return None
+        return jpeg_filename, None
     except Exception as e:
-        with progress_lock:
-            download_progress["count"] += 1
-        return f"  [{download_progress['count']}/{download_progress['total']}] ✗ 处理图片ID {image_id} 失败: {e}"
+        return None, f"  ✗ 处理图片ID {image_id} 失败: {e}"
 
-def create_zip_archive(source_dir, zip_filepath, files_to_zip):
-    """将指定文件压缩成zip。"""
-    print(f"\n[*] 正在将 {len(files_to_zip)} 个新图片文件创建到 ZIP 压缩包...")
-    try:
-        with zipfile.ZipFile(zip_filepath, 'w', zipfile.ZIP_DEFLATED) as zf:
-            for filename in files_to_zip:
-                filepath = os.path.join(source_dir, filename)
-                if os.path.exists(filepath):
-                    zf.write(filepath, arcname=filename)
-        
-        print(f"[*] 成功创建压缩包: {zip_filepath}")
-        
-    except Exception as e:
-        print(f"  ✗ 创建ZIP时出错: {e}")
+def _loads(data):
+    return orjson.loads(data) if orjson else json.loads(data)
+
+def _dumps(obj):
+    # 两种实现都输出 2 空格缩进、原样写出 UTF-8 字符（标准库需关闭 ensure_ascii），清单文件内容与所用的库无关
+    if orjson:
+        return orjson.dumps(obj, option=orjson.OPT_INDENT_2 | orjson.OPT_NON_STR_KEYS)
+    return json.dumps(obj, indent=2, ensure_ascii=False).encode()
 
 def load_manifest(manifest_path):
     if os.path.exists(manifest_path):
-        with open(manifest_path, 'r') as f:
+        with open(manifest_path, 'rb') as f:
             print(f"[*] 成功加载本地清单: {manifest_path}")
-            return json.load(f)
+            # JSON 的键只能是字符串；载入时一次性转回 int，内存中统一使用 Civitai 原生的整数 ID
+            return {int(image_id): img for image_id, img in _loads(f.read()).items()}
     print("[*] 未找到本地清单文件，将视为首次运行。")
     return {}
 
 def save_manifest(manifest_path, data):
-    with open(manifest_path, 'w') as f:
-        json.dump(data, f, indent=4)
+    # 先写入同目录下的临时文件并刷到磁盘，再原子地替换旧清单；中途崩溃不会留下损坏的清单导致下次全量重下
+    tmp_path = manifest_path + ".tmp"
+    with open(tmp_path, 'wb') as f:
+        f.write(_dumps(data))
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, manifest_path)
     print(f"[*] 已将最新清单保存到: {manifest_path}")
 
 def generate_reports(reports_dir, new_images, deleted_images_data):
     os.makedirs(reports_dir, exist_ok=True)
     
+    # 先在内存中拼好每个文件的全部行，再一次 writelines 写出，代替逐行 f.write
+    lines = [
+        f"# Civitai 同步报告 - {datetime.utcnow().strftime('%Y-%m-%d %H:%M:%S UTC')}\n\n",
+        f"- **新增图片**: {len(new_images)} 张\n",
+        f"- **删除图片**: {len(deleted_images_data)} 张\n\n",
+        "## 新增图片详情\n",
+    ]
+    if new_images:
+        lines.extend(f"- ID: {img['id']}, URL: {img['url']}\n" for img in new_images)
+    else:
+        lines.append("无\n")
+    
+    lines.append("\n## 删除图片详情\n")
+    if deleted_images_data:
+        lines.extend(f"- ID: {img['id']}, Username: {img['username']}\n" for img in deleted_images_data)
+    else:
+        lines.append("无\n")
+    
     summary_path = os.path.join(reports_dir, "summary.md")
-    with open(summary_path, 'w') as f:
-        f.write(f"# Civitai 同步报告 - {datetime.utcnow().strftime('%Y-%m-%d %H:%M:%S UTC')}\n\n")
-        f.write(f"- **新增图片**: {len(new_images)} 张\n")
-        f.write(f"- **删除图片**: {len(deleted_images_data)} 张\n\n")
-        
-        f.write("## 新增图片详情\n")
-        if new_images:
-            for img in new_images:
-                f.write(f"- ID: {img['id']}, URL: {img['url']}\n")
-        else:
-            f.write("无\n")
-            
-        f.write("\n## 删除图片详情\n")
-        if deleted_images_data:
-            for img in deleted_images_data:
-                f.write(f"- ID: {img['id']}, Username: {img['username']}\n")
-        else:
-            f.write("无\n")
+    with open(summary_path, 'w', buffering=1 << 20) as f:
+        f.writelines(lines)
     print(f"[*] 报告摘要已生成: {summary_path}")
 
-    with open(os.path.join(reports_dir, "new_images_ids.txt"), 'w') as f:
-        for img in new_images:
-            f.write(f"{img['id']}\n")
+    with open(os.path.join(reports_dir, "new_images_ids.txt"), 'w', buffering=1 << 20) as f:
+        f.writelines(f"{img['id']}\n" for img in new_images)
             
-    with open(os.path.join(reports_dir, "deleted_images_ids.txt"), 'w') as f:
-        for img in deleted_images_data:
-            f.write(f"{img['id']}\n")
+    with open(os.path.join(reports_dir, "deleted_images_ids.txt"), 'w', buffering=1 << 20) as f:
+        f.writelines(f"{img['id']}\n" for img in deleted_images_data)
 
 def main(args):
-    global download_progress
+    configure_session(args.threads)
 
     output_dir = args.output_dir
     creator_username = args.username
@@ -154,7 +216,7 @@ def main(args):
     reports_dir = os.path.join(output_dir, "reports")
     
     old_manifest = load_manifest(manifest_path)
-    old_image_ids = set(old_manifest.keys())
+    old_image_ids = old_manifest.keys()
 
     # 使用传入的参数来构建API请求
     api_params = {
@@ -164,17 +226,26 @@ def main(args):
         "period": "AllTime", # 同步时通常用AllTime
         "nsfw": args.nsfw
     }
-    current_image_list = fetch_all_image_metadata(api_params)
+    # 按 Newest 排序且已有清单时只增量获取新图片；删除检测需要完整列表，由 --full-scan 定期执行
+    incremental = bool(old_manifest) and args.sort == "Newest" and not args.full_scan
+    current_image_list, completed = fetch_all_image_metadata(api_params, old_image_ids if incremental else None)
+    if incremental and not completed:
+        # 增量结果只有出错前的几页：若据此合并保存清单，下次增量同步会在已知图片处停止，
+        # 中断处之后的新图片就再也不会被获取。保持旧清单不变并以失败退出，下次运行重新获取
+        print("[ERROR] 增量获取中途失败，未到达上次同步过的图片，保持旧清单不变。")
+        sys.exit(1)
     
-    current_images_map = {str(img['id']): img for img in current_image_list}
-    current_image_ids = set(current_images_map.keys())
+    # 直接以整数 ID 为键，不再为每张图片创建字符串；保存时 json 会自动把整数键写成字符串，清单格式不变
+    current_images_map = {img['id']: img for img in current_image_list}
 
     print("\n[2/4] 正在比较新旧图片列表...")
-    new_image_ids = current_image_ids - old_image_ids
-    deleted_image_ids = old_image_ids - current_image_ids
-    
-    new_images = [current_images_map[id] for id in new_image_ids]
-    deleted_images_data = [old_manifest[id] for id in deleted_image_ids]
+    # dict 的 keys() 视图直接支持集合运算，无需先复制成 set
+    new_images = [current_images_map[i] for i in current_images_map.keys() - old_image_ids]
+    if incremental:
+        print("[*] 增量同步只获取了最新的图片，跳过删除检测（使用 --full-scan 检查删除）。")
+        deleted_images_data = []
+    else:
+        deleted_images_data = [old_manifest[i] for i in old_image_ids - current_images_map.keys()]
 
     print(f"[*] 比较完成: {len(new_images)} 张新增, {len(deleted_images_data)} 张删除。")
 
@@ -186,39 +257,44 @@ def main(args):
 
     if new_images:
         print(f"\n[4/4] 发现 {len(new_images)} 张新图片，开始下载...")
-        temp_download_dir = os.path.join(output_dir, "new_images_temp")
-        os.makedirs(temp_download_dir, exist_ok=True)
-        
-        download_progress["total"] = len(new_images)
-        download_progress["count"] = 0
+        # 编码后的 JPEG 直接写入压缩包，不再经过临时目录落盘、重新读取和删除
+        zip_filename = f"civitai_{creator_username}_new_{datetime.utcnow().strftime('%Y%m%d')}.zip"
+        zip_filepath = os.path.join(output_dir, zip_filename)
+        os.makedirs(output_dir, exist_ok=True)
+        # deflate 模式使用 zlib 最快的 1 级：JPEG 几乎压不动，更高级别只会多花 CPU；stored 模式忽略该参数
+        zf = zipfile.ZipFile(zip_filepath, 'w', ZIP_COMPRESSION[args.zip_compression], compresslevel=1)
         
-        with ThreadPoolExecutor(max_workers=args.threads) as executor:
-            futures = {executor.submit(download_and_convert_image, img_data, temp_download_dir, args.jpeg_quality): img_data for img_data in new_images}
+        # 线程池负责网络下载，进程池负责 CPU 密集的解码/编码，两者互不阻塞
+        # 进程池在下载线程运行时才启动工作进程，fork 会把其他线程持有的锁原样复制进子进程；
+        # 改用 forkserver 从干净的服务进程派生（Windows 不支持 forkserver，退回 spawn）
+        start_method = "forkserver" if "forkserver" in multiprocessing.get_all_start_methods() else "spawn"
+        with zf, ProcessPoolExecutor(max_workers=os.cpu_count(), initializer=init_encoder, mp_context=multiprocessing.get_context(start_method)) as encoder, ThreadPoolExecutor(max_workers=args.threads) as executor:
+            futures = {executor.submit(download_and_convert_image, img_data, zf, args.jpeg_quality, encoder, args.jpeg_optimize, args.passthrough_jpeg): img_data for img_data in new_images}
             
             downloaded_filenames = []
-            for future in as_completed(futures):
+            # 进度由主线程的 tqdm 按固定频率刷新，工作线程不再为每张图片加锁和 print
+            for future in tqdm(as_completed(futures), total=len(futures), smoothing=0.1, mininterval=0.2):
                 img_data = futures[future]
                 try:
-                    result = future.result()
-                    if result:
-                        print(result)
+                    # 只记录真正写入压缩包的文件名，由工作线程返回，避免与其实际使用的文件名不一致
+                    filename, error = future.result()
+                    if error is None:
+                        downloaded_filenames.append(filename)
                     else:
-                        downloaded_filenames.append(f"{img_data['username']}_{img_data['id']}.jpeg")
+                        tqdm.write(error)
                 except Exception as exc:
-                    print(f"  ✗ 图片ID {img_data['id']} 生成异常: {exc}")
+                    tqdm.write(f"  ✗ 图片ID {img_data['id']} 生成异常: {exc}")
 
         if downloaded_filenames:
-            zip_filename = f"civitai_{creator_username}_new_{datetime.utcnow().strftime('%Y%m%d')}.zip"
-            zip_filepath = os.path.join(output_dir, zip_filename)
-            create_zip_archive(temp_download_dir, zip_filepath, downloaded_filenames)
-
-        print("[*] 正在清理临时下载目录...")
-        for file in os.listdir(temp_download_dir):
-            os.remove(os.path.join(temp_download_dir, file))
-        os.rmdir(temp_download_dir)
+            print(f"\n[*] 成功将 {len(downloaded_filenames)} 个新图片文件写入压缩包: {zip_filepath}")
+        else:
+            os.remove(zip_filepath)
     else:
         print("\n[4/4] 没有新图片需要下载。")
 
+    if incremental:
+        # 增量结果只包含最新的几页，需要合并进旧清单，否则未获取到的旧图片会从清单中丢失
+        current_images_map = {**old_manifest, **current_images_map}
     save_manifest(manifest_path, current_images_map)
 
     print("\n[SUCCESS] 同步任务完成！")
@@ -232,8 +308,12 @@ if __name__ == "__main__":
     # 添加回来的参数，并设置你想要的默认值
     parser.add_argument("--nsfw", type=str, default="X", choices=["None", "Soft", "Mature", "X"], help="Filter by NSFW level. Default: X")
     parser.add_argument("--sort", type=str, default="Newest", choices=["Most Reactions", "Most Comments", "Newest"], help="Sorting order for the images. Default: Newest")
+    parser.add_argument("--full-scan", action="store_true", help="Fetch the creator's full image list instead of stopping at the last synced image. Required to detect deleted images.")
     parser.add_argument("--threads", type=int, default=16, help="Number of download threads. Default: 16")
     parser.add_argument("--jpeg-quality", type=int, default=85, help="JPEG conversion quality.")
+    parser.add_argument("--zip-compression", type=str, default="stored", choices=list(ZIP_COMPRESSION), help="Compression for the ZIP archive. JPEGs barely shrink under deflate. Default: stored")
+    parser.add_argument("--passthrough-jpeg", action=argparse.BooleanOptionalAction, default=True, help="Store source images that are already JPEG as-is instead of re-encoding them. Default: on")
+    parser.add_argument("--jpeg-optimize", action="store_true", help="Write progressive JPEGs with optimized Huffman tables (smaller ZIP, slower encode).")
     
     cli_args = parser.parse_args()
     main(cli_args)